@@ -1,20 +1,29 @@
 import os
 import random
 import httpx
-import base64
+import pybase64
 import asyncio
+import contextlib
 import logging
+import aiofiles
+import functools
+import itertools
 from pathlib import Path
 from datetime import datetime
 from dotenv import load_dotenv
-from typing import Dict, Optional
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Type, TypeVar, Union
 
 from volcenginesdkarkruntime import AsyncArk 
+from volcenginesdkarkruntime._exceptions import ArkAPIConnectionError, ArkInternalServerError, ArkRateLimitError
 
 
 # --- 1. 初始化与配置 ---
 logger = logging.getLogger(Path(__file__).name)
 
+BASE_DIR = Path(__file__).resolve().parent
+INPUT_DIR = BASE_DIR / "input"
+OUTPUT_DIR = BASE_DIR / "output"
+
 def setup_logging():
     logging.basicConfig(
         level=logging.INFO,
@@ -25,51 +34,138 @@ def setup_logging():
 setup_logging()
 load_dotenv()
 
-# 并发限制与客户端初始化
-sem = asyncio.Semaphore(5)
+# 并发限制与客户端初始化（生成接口与下载分开限流）
+# ARK_MAX_CONCURRENCY 为生成接口的全局并发上限（按 Ark 限流策略调整），
+# ARK_MAX_CONCURRENCY_PER_REF 为每张参考图的并发上限；实际并发 = min(全局上限, 单图上限 x 参考图数量)
+ARK_MAX_CONCURRENCY = int(os.environ.get("ARK_MAX_CONCURRENCY", "16"))
+ARK_MAX_CONCURRENCY_PER_REF = int(os.environ.get("ARK_MAX_CONCURRENCY_PER_REF", "5"))
+DOWNLOAD_MAX_CONCURRENCY = int(os.environ.get("DOWNLOAD_MAX_CONCURRENCY", "32"))
+sem = asyncio.Semaphore(ARK_MAX_CONCURRENCY)
+download_sem = asyncio.Semaphore(DOWNLOAD_MAX_CONCURRENCY)
+# 每次写盘的块大小：aiofiles 每次 write 都要切一次线程，块大些可减少切换，同时内存占用仍有上限
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# 输出文件名：本次运行时间戳 + 自增序号，保证并发下唯一且多次运行不互相覆盖
+_run_stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+_file_counter = itertools.count()
+# Ark 接口同样走 HTTP/2 多路复用，并发请求共享同一条 TCP/TLS 连接
+ark_http_client = httpx.AsyncClient(
+    timeout=600,
+    limits=httpx.Limits(max_connections=ARK_MAX_CONCURRENCY, max_keepalive_connections=ARK_MAX_CONCURRENCY),
+    http2=True,
+)
 client = AsyncArk(
     base_url="https://ark.cn-beijing.volces.com/api/v3",
     api_key=os.environ.get("ARK_API_KEY"),
+    http_client=ark_http_client,
+    max_retries=0,  # 重试统一由 retry_async 负责，避免与 SDK 自带重试叠加成倍计费
+)
+# 复用同一个下载客户端，共享连接池 / keep-alive，避免每张图重新握手
+http_client = httpx.AsyncClient(
+    timeout=60,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    http2=True,
 )
 
 # --- 2. 工具层 (Utilities) ---
+T = TypeVar("T")
+MAX_ATTEMPTS = 3
+
+async def retry_async(
+    func: Callable[[], Awaitable[T]],
+    retry_on: Tuple[Type[BaseException], ...],
+    desc: str,
+    retry_if: Optional[Callable[[BaseException], bool]] = None,
+) -> T:
+    """对瞬时错误做有限次重试（指数退避 + 随机抖动），最后一次失败或 retry_if 判定不可重试时原样抛出"""
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return await func()
+        except retry_on as e:
+            if attempt == MAX_ATTEMPTS or (retry_if is not None and not retry_if(e)):
+                raise
+            delay = min(2 ** (attempt - 1), 10) + random.random()
+            logger.warning("%s失败（第 %d 次），%.1fs 后重试: %s", desc, attempt, delay, e)
+            await asyncio.sleep(delay)
+
+def is_retryable_http_error(e: BaseException) -> bool:
+    """网络层异常或 429/5xx 可重试；其余 4xx（如签名 URL 过期的 403/404）重试也不会成功"""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, httpx.TransportError)
+
+def sniff_image_mime(data: bytes) -> str:
+    """根据文件头魔数判断图片 MIME 类型"""
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    return "application/octet-stream"
+
 def image_localpath_to_base64(filename: str) -> Optional[str]:
     """【解耦】仅负责：本地文件 -> Base64"""
-    target_path = Path(__file__).resolve().parent / "input" / filename
+    target_path = INPUT_DIR / filename
     try:
         if not target_path.exists():
-            logger.error(f"找不到输入文件: {target_path}")
+            logger.error("找不到输入文件: %s", target_path)
             return None
-        encoded = base64.b64encode(target_path.read_bytes()).decode("utf-8")
-        return f"data:image/jpeg;base64,{encoded}"
+        data = target_path.read_bytes()
+        # 直接编码为 str 再拼接前缀，少一次大字符串的中间拷贝
+        return f"data:{sniff_image_mime(data)};base64," + pybase64.b64encode_as_string(data)
     except Exception as e:
-        logger.error(f"Base64转换失败: {e}")
+        logger.error("Base64转换失败: %s", e)
         return None
 
+_ref_image_tasks: Dict[str, "asyncio.Task[Optional[str]]"] = {}
+
+async def load_ref_image(filename: str) -> Optional[str]:
+    """在线程池中读取并编码参考图；同一文件只处理一次，并发任务共享结果，命中后不再进线程池"""
+    task = _ref_image_tasks.get(filename)
+    if task is None:
+        task = asyncio.ensure_future(asyncio.to_thread(image_localpath_to_base64, filename))
+        _ref_image_tasks[filename] = task
+    return await task
+
 async def image_url_to_localpath(url: str, subdir: Optional[str] = None) -> Optional[Path]:
-    """【解耦】仅负责: 远程URL -> 本地文件存储"""
-    output_dir = Path(__file__).resolve().parent / "output" if subdir is None else Path(__file__).resolve().parent / "output" / subdir
+    """【解耦】仅负责: 远程URL -> 本地文件存储（输出目录需由调用方提前创建）"""
+    output_dir = OUTPUT_DIR if subdir is None else OUTPUT_DIR / subdir
 
-    try:
-        output_dir.mkdir(parents=True, exist_ok=True)
-        target_path = output_dir / f"{datetime.now().strftime("%Y%m%d_%H%M%S_%f")}.png"
-        async with httpx.AsyncClient() as http_client:
-            resp = await http_client.get(url, timeout=60)
+    target_path = output_dir / f"{_run_stamp}_{next(_file_counter):08d}.png"
+    # 先写临时文件，下载完整后再改名，失败时不会在输出目录留下空文件或半截图片
+    part_path = target_path.with_name(target_path.name + ".part")
+
+    async def download():
+        # 流式分块写盘，避免整张图缓存在内存里，也不阻塞事件循环
+        async with download_sem, http_client.stream("GET", url) as resp:
             resp.raise_for_status()
-            target_path.write_bytes(resp.content)
-            return target_path
+            async with aiofiles.open(part_path, "wb") as f:
+                async for chunk in resp.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    await f.write(chunk)
+        part_path.replace(target_path)
+
+    try:
+        await retry_async(
+            download, (httpx.TransportError, httpx.HTTPStatusError), "图片下载", retry_if=is_retryable_http_error
+        )
+        return target_path
     except Exception as e:
-        logger.error(f"网络下载失败: {e}")
+        part_path.unlink(missing_ok=True)
+        logger.error("网络下载失败: %s", e)
         return None
 
 # --- 3. 原子功能层 (API Core) ---
-async def image_generate_api(prompt:str, ref_image: Optional[str] = None) -> Optional[str]:
-    """【解耦】仅负责：输入数据 -> 调用接口 -> 返回URL"""
-    async with sem:  # 在此处控制并发
-        try:
-            response = await client.images.generate(
+# 仅对连接异常、限流与服务端 5xx 重试；4xx（参数错误、内容审核、鉴权等）重试也不会成功
+ARK_RETRYABLE_ERRORS = (ArkAPIConnectionError, ArkRateLimitError, ArkInternalServerError)
+
+async def image_generate_api(prompt: Union[str, Callable[[], str]], ref_image: Optional[str] = None, limiter: Optional[asyncio.Semaphore] = None) -> Optional[str]:
+    """【解耦】仅负责：输入数据 -> 调用接口 -> 返回URL（prompt 可传生成函数，每次重试重新生成；limiter 为额外的分组限流，全局 sem 始终生效）"""
+    async def generate():
+        prompt_text = prompt() if callable(prompt) else prompt
+        logger.info("🚀 启动任务: %s", prompt_text)
+        # 在此处控制并发：先占分组名额再占全局名额（退避等待时不占用名额）
+        async with limiter or contextlib.nullcontext(), sem:
+            return await client.images.generate(
                 model=os.environ.get("ARK_GEN_IMAGE_MODEL"), 
-                prompt=prompt,
+                prompt=prompt_text,
                 image=ref_image,
                 sequential_image_generation="disabled",
                 response_format="url",
@@ -77,24 +173,37 @@ async def image_generate_api(prompt:str, ref_image: Optional[str] = None) -> Opt
                 stream=False,
                 watermark=False
             ) 
-            return response.data[0].url
-        except Exception as e:
-            logger.error(f"Ark 图片生成 API 调用异常: {e}")
-            return None
+
+    try:
+        response = await retry_async(generate, ARK_RETRYABLE_ERRORS, "Ark 图片生成")
+        return response.data[0].url
+    except Exception as e:
+        logger.error("Ark 图片生成 API 调用异常: %s", e)
+        return None
 
 # --- 4. 业务流层 (核心解耦点) ---
-async def run_single_task(task_config: Dict[str, str]):
+BACKGROUNDS = ("机场", "高铁站", "广场", "商场", "咖啡厅", "公园", "街头", "艺术展厅", "酒店大堂")
+POSES = ("正面", "侧面", "四分之三侧面", "微微侧身")
+
+def make_prompt(name: str) -> str:
+    """根据人物名生成提示词，背景与朝向每次随机"""
+    return f"{name}将参考图中的围巾随意地绕在脖子上，背景在{random.choice(BACKGROUNDS)},人物{random.choice(POSES)}朝向镜头,围巾中的图案和字母可以不用太清晰,时尚街拍风格浅景深，背景虚化，真实摄影。,比例1:1"
+
+async def run_single_task(task_config: Dict[str, str], limiter: Optional[asyncio.Semaphore] = None):
     """处理单个任务：提取参数 -> 转换 -> 生成 -> 保存"""
-    prompt = task_config.get("prompt")
+    # 未显式给出 prompt 时，交给生成层按人物名现场生成，每次重试都有新的随机组合
+    prompt = task_config.get("prompt") or functools.partial(make_prompt, task_config["name"])
     ref_file = task_config.get("ref_file")
     batch_subdir = task_config.get("batch_subdir")
     
-    # 1. 预处理
-    b64_data = image_localpath_to_base64(ref_file) if ref_file else None
+    # 1. 预处理（读文件与编码放到线程里，避免阻塞其他任务的网络 I/O）
+    b64_data = await load_ref_image(ref_file) if ref_file else None
+    if ref_file and b64_data is None:
+        logger.error("参考图不可用，跳过任务: %s", ref_file)
+        return
     
     # 2. 执行生成
-    logger.info(f"🚀 启动任务: {prompt}")
-    url = await image_generate_api(prompt, b64_data)
+    url = await image_generate_api(prompt, b64_data, limiter)
     
     # 3. 后处理
     if url:
@@ -103,21 +212,29 @@ async def run_single_task(task_config: Dict[str, str]):
 # --- 5. 执行入口 ---
 async def main():
     ref_name_list = ["刘亦菲","肖战","赵露思","王嘉尔","杨幂","杨紫","蔡徐坤","迪丽热巴","赵丽颖","权志龙"]
-    ref_image_name_list = [name for name in os.listdir("input") if os.path.isfile(os.path.join("input", name))]
+    with os.scandir(INPUT_DIR) as it:
+        ref_image_name_list = [entry.name for entry in it if entry.is_file()]
     # ref_image_name_list = ["lv nfc 卡其色.png"]
     run_batch_name = datetime.now().strftime("%Y%m%d_%H%M%S")
     tasks_to_run = [
         {
-            "prompt": f"{name}将参考图中的围巾随意地绕在脖子上，背景在{random.choice(['机场', '高铁站', '广场', '商场', '咖啡厅','公园','街头','艺术展厅','酒店大堂'])},人物{random.choice(['正面', '侧面', '四分之三侧面','微微侧身'])}朝向镜头,围巾中的图案和字母可以不用太清晰,时尚街拍风格浅景深，背景虚化，真实摄影。,比例1:1", 
+            "name": name,
             "ref_file": img,
             "batch_subdir":img.replace('.', '_')
         }
         for name in ref_name_list
         for img in ref_image_name_list
     ]
+    # 输出目录按批次统一创建一次，不在每个任务里重复 mkdir
+    for batch_subdir in {task["batch_subdir"] for task in tasks_to_run}:
+        (OUTPUT_DIR / batch_subdir).mkdir(parents=True, exist_ok=True)
+    # 每张参考图一条独立流水线，各自限流，互不争抢同一个并发窗口
+    ref_limiters = {img: asyncio.Semaphore(ARK_MAX_CONCURRENCY_PER_REF) for img in ref_image_name_list}
     # 并发启动所有任务
-    logger.info(f"🔥 开始并发执行 {len(tasks_to_run)} 个任务...")
-    await asyncio.gather(*(run_single_task(task) for task in tasks_to_run))
+    logger.info("🔥 开始并发执行 %d 个任务...", len(tasks_to_run))
+    async with ark_http_client, http_client, asyncio.TaskGroup() as tg:
+        for task in tasks_to_run:
+            tg.create_task(run_single_task(task, ref_limiters[task["ref_file"]]))
     logger.info("✨ 所有任务处理完毕")
 
 if __name__ == "__main__":